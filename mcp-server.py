@@ -1,24 +1,68 @@
 #!/usr/bin/env python3
 """MCP Super Root Maestro - Servidor Principal v2.2.0"""
 
-from fastapi import FastAPI, HTTPException, WebSocket, Depends
+from fastapi import FastAPI, HTTPException, WebSocket, Depends, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse, PlainTextResponse
+from typing import Optional
+from collections import Counter as FrameCounter, deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
 import uvicorn
+import httpx
 import json
-import redis
 import asyncio
+import base64
+import bisect
+import heapq
+import itertools
+import zlib
 from datetime import datetime
-from prometheus_client import Counter, Histogram, generate_latest
+from prometheus_client import Counter, Gauge, Histogram, generate_latest
 from prometheus_client import CONTENT_TYPE_LATEST
 import os
 import subprocess
 import signal
+import sys
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Métricas Prometheus
 REQUEST_COUNT = Counter('mcp_requests_total', 'Total requests', ['method', 'endpoint'])
 REQUEST_DURATION = Histogram('mcp_request_duration_seconds', 'Request duration')
+LOOP_LAG = Histogram('mcp_event_loop_lag_seconds', 'Event loop scheduling delay',
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+LOOP_STALLS = Counter('mcp_event_loop_stalls_total', 'Event loop stalls above threshold')
+WS_CONNECTIONS = Gauge('mcp_ws_connections', 'Active WebSocket connections')
+WS_MEMORY_PER_CONNECTION = Gauge('mcp_ws_memory_per_connection_bytes',
+                                 'Process RSS growth since startup divided by active connections')
+WS_EVICTIONS = Counter('mcp_ws_evictions_total', 'WebSocket clients dropped by the server', ['reason'])
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Arranque y parada de clientes compartidos y tareas de fondo"""
+    await redis_pool.start()
+    loop_monitor.start()
+    process_sampler.start()
+    manager.start()
+    await fleet.start()
+    try:
+        yield
+    finally:
+        await fleet.stop()
+        await manager.stop()
+        await process_sampler.stop()
+        await loop_monitor.stop()
+        await redis_pool.stop()
 
 # FastAPI app con configuración completa
 app = FastAPI(
@@ -27,14 +71,96 @@ app = FastAPI(
     version="2.2.0",
     docs_url="/docs",
     redoc_url="/redoc",
-    openapi_url="/openapi.json"
+    openapi_url="/openapi.json",
+    lifespan=lifespan
 )
 
 # Configuración Redis
-try:
-    redis_client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379"))
-except:
-    redis_client = None
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+REDIS_POOL_SIZE = int(os.getenv("MCP_REDIS_POOL_SIZE", "20"))
+REDIS_POOL_TIMEOUT = float(os.getenv("MCP_REDIS_POOL_TIMEOUT", "2"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("MCP_REDIS_SOCKET_TIMEOUT", "1"))
+REDIS_RETRIES = int(os.getenv("MCP_REDIS_RETRIES", "3"))
+REDIS_BACKOFF_BASE = float(os.getenv("MCP_REDIS_BACKOFF_BASE", "0.05"))
+REDIS_BACKOFF_CAP = float(os.getenv("MCP_REDIS_BACKOFF_CAP", "2"))
+READINESS_TTL = float(os.getenv("MCP_READINESS_TTL", "5"))
+
+class RedisPool:
+    """Async Redis connection pool with a cached PING readiness probe"""
+
+    def __init__(self, url: str, size: int, pool_timeout: float, socket_timeout: float,
+                 retries: int, backoff_base: float, backoff_cap: float, readiness_ttl: float):
+        self.url = url
+        self.size = size
+        self.pool_timeout = pool_timeout
+        self.socket_timeout = socket_timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.readiness_ttl = readiness_ttl
+        self.pool: Optional[BlockingConnectionPool] = None
+        self.client: Optional[Redis] = None
+        self._readiness = {"status": "unknown"}
+        self._checked_at = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        try:
+            self.pool = BlockingConnectionPool.from_url(
+                self.url,
+                max_connections=self.size,
+                timeout=self.pool_timeout,
+                socket_timeout=self.socket_timeout,
+                socket_connect_timeout=self.socket_timeout,
+                retry=Retry(ExponentialBackoff(cap=self.backoff_cap, base=self.backoff_base),
+                            self.retries),
+                retry_on_timeout=True
+            )
+            self.client = Redis(connection_pool=self.pool)
+        except Exception as e:
+            self.pool = self.client = None
+            self._readiness = {"status": "disconnected", "error": str(e)}
+
+    async def stop(self):
+        if self.client:
+            await self.client.aclose()
+        if self.pool:
+            await self.pool.disconnect()
+        self.pool = self.client = None
+
+    def saturation(self) -> float:
+        if not self.pool:
+            return 0.0
+        # redis-py no expone las conexiones en uso de forma pública
+        return round(len(self.pool._in_use_connections) / self.size, 3)
+
+    async def readiness(self) -> dict:
+        """PING round-trip and pool saturation, cached for readiness_ttl seconds"""
+        if self.client is None:
+            return self._readiness
+        if self._checked_at is not None and time.monotonic() - self._checked_at < self.readiness_ttl:
+            return self._readiness
+        async with self._lock:
+            # Otra petición pudo refrescar el resultado mientras esperábamos el lock
+            if self._checked_at is not None and time.monotonic() - self._checked_at < self.readiness_ttl:
+                return self._readiness
+            start = time.monotonic()
+            try:
+                await self.client.ping()
+                self._readiness = {
+                    "status": "connected",
+                    "ping_ms": round((time.monotonic() - start) * 1000, 2)
+                }
+            except Exception as e:
+                self._readiness = {"status": "disconnected",
+                                   "error": f"{type(e).__name__}: {e}" if str(e) else type(e).__name__}
+            self._readiness["pool_saturation"] = self.saturation()
+            self._readiness["checked_at"] = datetime.now().isoformat()
+            self._checked_at = time.monotonic()
+        return self._readiness
+
+redis_pool = RedisPool(REDIS_URL, REDIS_POOL_SIZE, REDIS_POOL_TIMEOUT, REDIS_SOCKET_TIMEOUT,
+                       REDIS_RETRIES, REDIS_BACKOFF_BASE, REDIS_BACKOFF_CAP, READINESS_TTL)
 
 # Configuración OAuth2
 security = HTTPBearer()
@@ -55,25 +181,178 @@ app.add_middleware(
 )
 
 # WebSocket manager
+WS_MAX_CONNECTIONS = int(os.getenv("MCP_WS_MAX_CONNECTIONS", "60000"))
+WS_PING_INTERVAL = float(os.getenv("MCP_WS_PING_INTERVAL", "30"))
+WS_IDLE_TIMEOUT = float(os.getenv("MCP_WS_IDLE_TIMEOUT", "90"))
+WS_MAX_QUEUE = int(os.getenv("MCP_WS_MAX_QUEUE", "32"))
+WS_SEND_TIMEOUT = float(os.getenv("MCP_WS_SEND_TIMEOUT", "5"))
+# "opt-in": solo los clientes que envían {"type": "pong"} reciben pings JSON y pueden
+# desconectarse por inactividad; "all": se aplica a todos los clientes
+WS_APP_HEARTBEAT = os.getenv("MCP_WS_APP_HEARTBEAT", "opt-in")
+# Pings RFC 6455 de uvicorn: cierran sockets medio abiertos sin cambios en los clientes
+WS_PROTOCOL_PING_INTERVAL = float(os.getenv("MCP_WS_PROTOCOL_PING_INTERVAL", "20"))
+WS_PROTOCOL_PING_TIMEOUT = float(os.getenv("MCP_WS_PROTOCOL_PING_TIMEOUT", "20"))
+WS_CLOSE_TIMEOUT = 5.0
+
+def rss_bytes() -> int:
+    """Resident set size of this process (0 where /proc is unavailable)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+class ClientRecord:
+    """Per-connection state; slotted to keep idle connections cheap"""
+    __slots__ = ("id", "websocket", "channels", "last_seen", "queue_depth", "heartbeat")
+
+    def __init__(self, client_id: int, websocket: WebSocket, heartbeat: bool = False):
+        self.id = client_id
+        self.websocket = websocket
+        self.channels = None  # set() solo si el cliente se suscribe
+        self.last_seen = time.monotonic()
+        self.queue_depth = 0
+        self.heartbeat = heartbeat  # sujeto a pings JSON y desconexión por inactividad
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+    def __init__(self, max_connections: int, ping_interval: float, idle_timeout: float,
+                 max_queue: int, app_heartbeat: str = "opt-in"):
+        self.clients: dict[int, ClientRecord] = {}
+        self.max_connections = max_connections
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.max_queue = max_queue
+        self.app_heartbeat = app_heartbeat
+        self.baseline_rss = 0
+        self.memory_per_connection = 0.0
+        self._ids = itertools.count(1)
+        self._task = None
 
-    async def connect(self, websocket: WebSocket):
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    async def connect(self, websocket: WebSocket) -> Optional[ClientRecord]:
+        if len(self.clients) >= self.max_connections:
+            WS_EVICTIONS.labels(reason="capacity").inc()
+            # Cerrar antes de accept() se traduce en un 403 del handshake; así llega el 1013
+            await websocket.accept()
+            await websocket.close(code=1013)  # Try again later
+            return None
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = ClientRecord(next(self._ids), websocket, self.app_heartbeat == "all")
+        self.clients[client.id] = client
+        WS_CONNECTIONS.set(len(self.clients))
+        return client
+
+    def disconnect(self, client: ClientRecord):
+        if self.clients.pop(client.id, None) is not None:
+            WS_CONNECTIONS.set(len(self.clients))
+            if not self.clients:
+                self.update_memory_metric()
+
+    def handle_control(self, client: ClientRecord, data: str) -> bool:
+        """Apply pong/subscribe/unsubscribe messages; False for regular payloads"""
+        if not data.startswith("{"):
+            return False
+        try:
+            message = json.loads(data)
+        except ValueError:
+            return False
+        kind = message.get("type") if isinstance(message, dict) else None
+        if kind == "pong":
+            client.heartbeat = True  # el cliente acepta el heartbeat de aplicación
+            return True
+        if kind in ("subscribe", "unsubscribe") and isinstance(message.get("channel"), str):
+            if kind == "subscribe":
+                if client.channels is None:
+                    client.channels = set()
+                client.channels.add(message["channel"])
+            elif client.channels:
+                client.channels.discard(message["channel"])
+            return True
+        return False
+
+    async def send(self, client: ClientRecord, message: str):
+        client.queue_depth += 1
+        try:
+            await asyncio.wait_for(client.websocket.send_text(message), WS_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Buffer de socket lleno: no debe bloquear la ronda de heartbeat ni los broadcasts
+            await self.evict(client, "send_timeout")
+        except Exception:
+            self.disconnect(client)
+        finally:
+            client.queue_depth -= 1
+
+    async def broadcast(self, message: str, channel: Optional[str] = None) -> int:
+        targets = []
+        for client in self.clients.values():
+            if channel is not None and not (client.channels and channel in client.channels):
+                continue
+            if client.queue_depth >= self.max_queue:
+                continue  # consumidor lento: se descarta el mensaje en vez de acumular
+            targets.append(client)
+        await asyncio.gather(*(self.send(client, message) for client in targets))
+        return len(targets)
+
+    async def evict(self, client: ClientRecord, reason: str, code: int = 1008):
+        self.disconnect(client)
+        WS_EVICTIONS.labels(reason=reason).inc()
+        try:
+            await asyncio.wait_for(client.websocket.close(code=code), WS_CLOSE_TIMEOUT)
+        except Exception:
+            pass
+
+    async def heartbeat(self):
+        """Ping heartbeat clients and evict those silent for longer than idle_timeout"""
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            now = time.monotonic()
+            ping = json.dumps({"type": "ping", "timestamp": datetime.now().isoformat()})
+            pending = []
+            for client in list(self.clients.values()):
+                if not client.heartbeat:
+                    continue  # solo recibe broadcasts; lo vigilan los pings de protocolo
+                if now - client.last_seen > self.idle_timeout:
+                    pending.append(self.evict(client, "idle"))
+                elif client.queue_depth < self.max_queue:
+                    pending.append(self.send(client, ping))
+            await asyncio.gather(*pending)
+            self.update_memory_metric()
+
+    def update_memory_metric(self):
+        if not self.clients:
+            self.memory_per_connection = 0.0
+        elif self.baseline_rss:
+            growth = max(0, rss_bytes() - self.baseline_rss)
+            self.memory_per_connection = growth / len(self.clients)
+        WS_MEMORY_PER_CONNECTION.set(self.memory_per_connection)
+
+    def stats(self) -> dict:
+        self.update_memory_metric()
+        return {
+            "connections": len(self.clients),
+            "max_connections": self.max_connections,
+            "ping_interval": self.ping_interval,
+            "idle_timeout": self.idle_timeout,
+            "app_heartbeat": self.app_heartbeat,
+            "memory_per_connection": round(self.memory_per_connection, 1)
+        }
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+    def start(self):
+        self.baseline_rss = rss_bytes()
+        self._task = asyncio.get_running_loop().create_task(self.heartbeat())
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
             try:
-                await connection.send_text(message)
-            except:
+                await self._task
+            except asyncio.CancelledError:
                 pass
 
-manager = ConnectionManager()
+manager = ConnectionManager(WS_MAX_CONNECTIONS, WS_PING_INTERVAL, WS_IDLE_TIMEOUT, WS_MAX_QUEUE,
+                            WS_APP_HEARTBEAT)
 
 @app.get("/")
 async def root():
@@ -93,13 +372,15 @@ async def root():
 async def health():
     """Health check endpoint"""
     REQUEST_COUNT.labels(method="GET", endpoint="/health").inc()
-    redis_status = "connected" if redis_client else "disconnected"
+    # Liveness: siempre 200; el estado de Redis es informativo (503 solo en /health/ready)
+    readiness = await redis_pool.readiness()
     return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
         "service": "MCP Super Root Maestro",
         "version": "2.2.0",
-        "redis": redis_status,
+        "redis": readiness["status"],
+        "readiness": readiness,
         "components": {
             "api": "healthy",
             "websocket": "healthy",
@@ -108,6 +389,18 @@ async def health():
         }
     }
 
+@app.get("/health/live")
+async def health_live():
+    """Liveness: el proceso responde, sin tocar dependencias"""
+    return {"status": "alive", "timestamp": datetime.now().isoformat()}
+
+@app.get("/health/ready")
+async def health_ready():
+    """Readiness: PING a Redis (cacheado) y saturación del pool"""
+    readiness = await redis_pool.readiness()
+    status_code = 200 if readiness["status"] == "connected" else 503
+    return JSONResponse(status_code=status_code, content={"redis": readiness})
+
 @app.get("/status")
 async def status():
     """Sistema status completo"""
@@ -182,26 +475,326 @@ async def protected_endpoint(token: str = Depends(verify_token)):
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint para tiempo real"""
-    await manager.connect(websocket)
+    client = await manager.connect(websocket)
+    if client is None:
+        return
     try:
         while True:
             data = await websocket.receive_text()
+            client.last_seen = time.monotonic()
+            if manager.handle_control(client, data):
+                continue
             message = {
                 "type": "echo",
                 "data": data,
                 "timestamp": datetime.now().isoformat(),
-                "connections": len(manager.active_connections)
+                "connections": len(manager)
             }
             await manager.broadcast(json.dumps(message))
     except Exception:
-        manager.disconnect(websocket)
+        pass
+    finally:
+        manager.disconnect(client)
 
 @app.post("/broadcast")
-async def broadcast_message(message: dict):
-    """Broadcast mensaje a todos los WebSocket clientes"""
+async def broadcast_message(message: dict, channel: Optional[str] = None):
+    """Broadcast mensaje a todos los WebSocket clientes (o solo a los suscritos a un canal)"""
     REQUEST_COUNT.labels(method="POST", endpoint="/broadcast").inc()
-    await manager.broadcast(json.dumps(message))
-    return {"status": "broadcasted", "connections": len(manager.active_connections)}
+    delivered = await manager.broadcast(json.dumps(message), channel)
+    return {"status": "broadcasted", "connections": len(manager), "delivered": delivered}
+
+@app.get("/ws/stats")
+async def websocket_stats():
+    """Estado del registro de conexiones WebSocket"""
+    REQUEST_COUNT.labels(method="GET", endpoint="/ws/stats").inc()
+    return manager.stats()
+
+# ========================= RESPONSE SHAPING =========================
+
+# Respuestas por debajo de este tamaño no compensan el coste de comprimir
+COMPRESS_MIN_BYTES = int(os.getenv("MCP_COMPRESS_MIN_BYTES", "1024"))
+NDJSON_BATCH_LINES = 256
+
+def encode_cursor(values: tuple) -> str:
+    """Encode the sort key of the last returned item as an opaque cursor"""
+    raw = json.dumps(list(values), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    """Decode a cursor produced by encode_cursor"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return tuple(values)
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick zstd or gzip from an Accept-Encoding header, honouring q-values"""
+    offered = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        offered[token] = q
+    candidates = ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+    best, best_q = None, 0.0
+    for encoding in candidates:
+        q = offered.get(encoding, 0.0)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+def make_compressor(encoding: str):
+    """Streaming compressor exposing compress()/flush() for the given encoding"""
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    return zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+
+class ResponseShaper:
+    """Field projection, cursor pagination and negotiated encoding for /system/* responses"""
+
+    def __init__(self, request: Request, fields: Optional[str], cursor: Optional[str],
+                 limit: Optional[int], output: str):
+        self.fields = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+        self.cursor = cursor
+        self.limit = limit
+        self.output = output
+        self.encoding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+
+    def project(self, item: dict) -> dict:
+        if not self.fields:
+            return item
+        return {k: item[k] for k in self.fields if k in item}
+
+    def paginate(self, items: list, key: Optional[tuple]) -> tuple[list, Optional[str]]:
+        if key is None:
+            # Listas ya ordenadas por ranking: solo se recortan, sin cursor
+            return (items[:self.limit] if self.limit else items), None
+
+        def sort_key(item):
+            return tuple(item.get(k) for k in key)
+
+        ordered = sorted(items, key=sort_key)
+        start = 0
+        if self.cursor:
+            try:
+                start = bisect.bisect_right(ordered, decode_cursor(self.cursor), key=sort_key)
+            except TypeError:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+        if self.limit is None:
+            return ordered[start:], None
+        page = ordered[start:start + self.limit]
+        has_more = start + self.limit < len(ordered)
+        next_cursor = encode_cursor(sort_key(page[-1])) if page and has_more else None
+        return page, next_cursor
+
+    def render(self, payload: dict, items_field: Optional[str] = None,
+               items: Optional[list] = None, key: Optional[tuple] = ("pid",)) -> Response:
+        headers = {"Vary": "Accept-Encoding"}
+        if items is None:
+            return self._encode(self.project(payload), headers)
+
+        page, next_cursor = self.paginate(items, key)
+        page = [self.project(item) for item in page]
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+        if self.output == "ndjson":
+            # El sobre (totales, patrón, cursor) va como primera línea {"meta": {...}}
+            return self._stream({**payload, "next_cursor": next_cursor}, page, headers)
+        return self._encode({**payload, items_field: page, "next_cursor": next_cursor}, headers)
+
+    def _encode(self, body: dict, headers: dict) -> Response:
+        content = json.dumps(body, separators=(",", ":")).encode()
+        if self.encoding and len(content) >= COMPRESS_MIN_BYTES:
+            compressor = make_compressor(self.encoding)
+            content = compressor.compress(content) + compressor.flush()
+            headers["Content-Encoding"] = self.encoding
+        return Response(content=content, media_type="application/json", headers=headers)
+
+    def _stream(self, meta: dict, page: list, headers: dict) -> StreamingResponse:
+        compressor = make_compressor(self.encoding) if self.encoding else None
+        if compressor:
+            headers["Content-Encoding"] = self.encoding
+
+        def chunks():
+            header = (json.dumps({"meta": meta}, separators=(",", ":")) + "\n").encode()
+            chunk = compressor.compress(header) if compressor else header
+            if chunk:
+                yield chunk
+            for i in range(0, len(page), NDJSON_BATCH_LINES):
+                batch = "".join(json.dumps(item, separators=(",", ":")) + "\n"
+                                for item in page[i:i + NDJSON_BATCH_LINES]).encode()
+                chunk = compressor.compress(batch) if compressor else batch
+                if chunk:
+                    yield chunk
+            if compressor:
+                yield compressor.flush()
+
+        return StreamingResponse(chunks(), media_type="application/x-ndjson", headers=headers)
+
+def response_shaper(request: Request,
+                    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+                    cursor: Optional[str] = Query(None, description="Opaque cursor from X-Next-Cursor"),
+                    limit: Optional[int] = Query(None, ge=1, le=10000),
+                    output: str = Query("json", alias="format", pattern="^(json|ndjson)$")):
+    """Common response-shaping parameters for /system/* endpoints"""
+    return ResponseShaper(request, fields, cursor, limit, output)
+
+# ========================= EVENT LOOP DIAGNOSTICS =========================
+
+LOOP_LAG_INTERVAL = float(os.getenv("MCP_LOOP_LAG_INTERVAL", "0.1"))
+LOOP_STALL_THRESHOLD = float(os.getenv("MCP_LOOP_STALL_THRESHOLD", "0.25"))
+PROFILE_MAX_SECONDS = 30.0
+# Un único hilo propio para no ocupar el executor por defecto durante hasta 30 s
+profile_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profiler")
+profile_lock = asyncio.Lock()
+
+def collapse_stack(frame) -> str:
+    """Render a frame chain root-first in collapsed-stack (flamegraph) format"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class LoopLagMonitor:
+    """Heartbeat task measuring loop lag plus a watchdog thread that captures blocking stacks"""
+
+    def __init__(self, interval: float, threshold: float, history: int = 20):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = deque(maxlen=history)
+        self.max_lag = 0.0
+        self.stalls_total = 0
+        self.last_beat = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._watchdog = None
+        self._open_stall = None  # (heartbeat, entrada) del bloqueo aún sin medir
+        self._stop = threading.Event()
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            previous_beat, self.last_beat = self.last_beat, time.monotonic()
+            open_stall = self._open_stall
+            if open_stall is not None and open_stall[0] == previous_beat:
+                # El watchdog capturó este bloqueo; ahora se conoce su duración real
+                open_stall[1]["blocked_for"] = round(lag, 4)
+                self._open_stall = None
+            LOOP_LAG.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def _watch(self):
+        # Solo una captura por bloqueo: se identifica por el último heartbeat visto
+        captured_beat = None
+        while not self._stop.wait(self.interval):
+            beat = self.last_beat
+            blocked_for = time.monotonic() - beat - self.interval
+            if blocked_for < self.threshold or beat == captured_beat:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            captured_beat = beat
+            self.stalls_total += 1
+            LOOP_STALLS.inc()
+            entry = {
+                "detected_at": datetime.now().isoformat(),
+                "detected_after": round(blocked_for, 4),
+                "blocked_for": None,  # se completa cuando el loop vuelve a latir
+                "stack": collapse_stack(frame)
+            }
+            self._open_stall = (beat, entry)
+            self.stalls.append(entry)
+
+    def snapshot(self) -> dict:
+        return {
+            "interval": self.interval,
+            "threshold": self.threshold,
+            "max_lag": round(self.max_lag, 4),
+            "stalls_total": self.stalls_total,
+            "recent_stalls": list(self.stalls)
+        }
+
+loop_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD)
+
+def sample_stacks(duration: float, interval: float,
+                  thread_id: Optional[int] = None) -> FrameCounter:
+    """Count collapsed stacks of one thread, or of every thread when thread_id is None"""
+    # El propio muestreador y el watchdog solo añadirían ruido al flamegraph
+    skipped = {threading.get_ident()}
+    if loop_monitor._watchdog is not None:
+        skipped.add(loop_monitor._watchdog.ident)
+    stacks = FrameCounter()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        frames = sys._current_frames()
+        if thread_id is not None:
+            frame = frames.get(thread_id)
+            if frame is not None:
+                stacks[collapse_stack(frame)] += 1
+        else:
+            for ident, frame in frames.items():
+                if ident not in skipped:
+                    stacks[collapse_stack(frame)] += 1
+        time.sleep(interval)
+    return stacks
+
+@app.get("/debug/loop-lag")
+async def loop_lag(token: str = Depends(verify_token)):
+    """Event loop lag summary and stacks captured during recent stalls"""
+    REQUEST_COUNT.labels(method="GET", endpoint="/debug/loop-lag").inc()
+    return loop_monitor.snapshot()
+
+@app.get("/debug/profile")
+async def profile(seconds: float = Query(5.0, gt=0, le=PROFILE_MAX_SECONDS),
+                  interval: float = Query(0.005, ge=0.001, le=1.0),
+                  all_threads: bool = False,
+                  token: str = Depends(verify_token)):
+    """Time-boxed sampling profile of the event loop thread (or all threads) as collapsed stacks"""
+    REQUEST_COUNT.labels(method="GET", endpoint="/debug/profile").inc()
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    # Este handler corre en el hilo del event loop
+    loop_thread_id = None if all_threads else threading.get_ident()
+    async with profile_lock:
+        stacks = await asyncio.get_running_loop().run_in_executor(
+            profile_executor, sample_stacks, seconds, interval, loop_thread_id)
+    lines = [f"{stack} {count}" for stack, count in stacks.most_common()]
+    return PlainTextResponse("\n".join(lines) + "\n")
 
 # ========================= PROCESS MANAGEMENT ENDPOINTS =========================
 
@@ -265,38 +858,40 @@ async def kill_process_by_pid(pid: int, signal_type: str = "TERM"):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+def collect_processes(timeout: Optional[float] = None) -> list:
+    """Parse `ps aux` into process records"""
+    result = subprocess.run(['ps', 'aux'], capture_output=True, text=True, timeout=timeout)
+    lines = result.stdout.strip().split('\n')[1:]  # Skip header
+    processes = []
+    for line in lines:
+        parts = line.split(None, 10)
+        if len(parts) >= 11:
+            processes.append({
+                "user": parts[0],
+                "pid": int(parts[1]),
+                "cpu": parts[2],
+                "mem": parts[3],
+                "command": parts[10]
+            })
+    return processes
+
 @app.get("/system/processes")
-async def list_processes():
+async def list_processes(shaper: ResponseShaper = Depends(response_shaper)):
     """List processes using ps command"""
     try:
-        result = subprocess.run(['ps', 'aux'], capture_output=True, text=True)
-        lines = result.stdout.strip().split('\n')[1:]  # Skip header
-        processes = []
-        for line in lines[:50]:  # Limit to 50 processes
-            parts = line.split(None, 10)
-            if len(parts) >= 11:
-                processes.append({
-                    "user": parts[0],
-                    "pid": int(parts[1]),
-                    "cpu": parts[2],
-                    "mem": parts[3],
-                    "command": parts[10][:100]  # Truncate command
-                })
-        return {
-            "total_processes": len(processes),
-            "processes": processes
-        }
+        processes = collect_processes()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    return shaper.render({"total_processes": len(processes)}, "processes", processes)
 
 @app.get("/system/processes/search/{pattern}")
-async def search_processes(pattern: str):
+async def search_processes(pattern: str, shaper: ResponseShaper = Depends(response_shaper)):
     """Search processes by pattern using pgrep"""
     try:
         pids_result = subprocess.run(['pgrep', '-f', pattern], 
                                    capture_output=True, text=True)
         if not pids_result.stdout:
-            return {"pattern": pattern, "matches_found": 0, "processes": []}
+            return shaper.render({"pattern": pattern, "matches_found": 0}, "processes", [])
         
         pids = pids_result.stdout.strip().split('\n')
         processes = []
@@ -312,93 +907,235 @@ async def search_processes(pattern: str):
                             processes.append({
                                 "pid": int(parts[0]),
                                 "user": parts[1],
-                                "command": parts[2][:100]
+                                "command": parts[2]
                             })
             except:
                 continue
-        
-        return {
-            "pattern": pattern,
-            "matches_found": len(processes),
-            "processes": processes
-        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    return shaper.render({"pattern": pattern, "matches_found": len(processes)},
+                         "processes", processes)
+
+# ========================= PROCESS SAMPLER =========================
+
+SAMPLER_INTERVAL = float(os.getenv("MCP_SAMPLER_INTERVAL", "2.0"))
+SAMPLER_TOP_K = int(os.getenv("MCP_SAMPLER_TOP_K", "50"))
+SAMPLER_METRICS = ("cpu", "rss", "rss_growth", "read_bps", "write_bps")
+
+class ProcessSampler:
+    """Reads /proc at a fixed interval and keeps per-metric top-K rankings of interval rates"""
+
+    def __init__(self, interval: float, top_k: int, proc_root: str = "/proc"):
+        self.interval = interval
+        self.top_k = top_k
+        self.proc_root = proc_root
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.top = {metric: [] for metric in SAMPLER_METRICS}
+        self.sampled_at = None
+        self.process_count = 0
+        self.last_error = None
+        self._previous = {}
+        self._previous_time = None
+        self._task = None
+
+    @property
+    def available(self) -> bool:
+        return os.path.isdir(self.proc_root)
+
+    def read_process(self, pid: str) -> Optional[tuple]:
+        """Return ((pid, starttime), name, state, cpu_ticks, rss_bytes, read_bytes, write_bytes)"""
+        try:
+            with open(f"{self.proc_root}/{pid}/stat", "rb") as f:
+                stat = f.read().decode(errors="replace")
+        except OSError:
+            return None
+        # comm va entre paréntesis y puede contener espacios
+        name = stat[stat.find("(") + 1:stat.rfind(")")]
+        fields = stat[stat.rfind(")") + 2:].split()
+        read_bytes = write_bytes = 0
+        try:
+            with open(f"{self.proc_root}/{pid}/io", "rb") as f:
+                for line in f:
+                    if line.startswith(b"read_bytes:"):
+                        read_bytes = int(line.split()[1])
+                    elif line.startswith(b"write_bytes:"):
+                        write_bytes = int(line.split()[1])
+        except (OSError, ValueError):
+            pass  # /proc/[pid]/io requiere permisos sobre procesos ajenos
+        return ((int(pid), int(fields[19])), name, fields[0],
+                int(fields[11]) + int(fields[12]), int(fields[21]) * self.page_size,
+                read_bytes, write_bytes)
+
+    def sample(self):
+        now = time.monotonic()
+        current = {}
+        for entry in os.listdir(self.proc_root):
+            if entry.isdigit():
+                raw = self.read_process(entry)
+                if raw:
+                    current[raw[0]] = raw
+        records = []
+        elapsed = now - self._previous_time if self._previous_time else None
+        if elapsed:
+            for key, (_, name, state, ticks, rss, read_b, write_b) in current.items():
+                prev = self._previous.get(key)
+                if prev is None:
+                    continue  # proceso nuevo: sin intervalo previo con el que comparar
+                records.append({
+                    "pid": key[0],
+                    "name": name,
+                    "state": state,
+                    "cpu": round((ticks - prev[3]) / self.clock_ticks / elapsed * 100, 2),
+                    "rss": rss,
+                    "rss_growth": round((rss - prev[4]) / elapsed, 1),
+                    "read_bps": round(max(0, read_b - prev[5]) / elapsed, 1),
+                    "write_bps": round(max(0, write_b - prev[6]) / elapsed, 1)
+                })
+            self.top = {metric: heapq.nlargest(self.top_k, records, key=lambda r, m=metric: r[m])
+                        for metric in SAMPLER_METRICS}
+            self.sampled_at = datetime.now().isoformat()
+            self.process_count = len(records)
+        self._previous = current
+        self._previous_time = now
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sample)
+                self.last_error = None
+            except Exception as e:
+                # Se conserva el último error para el endpoint en vez de inundar stdout
+                self.last_error = f"{type(e).__name__}: {e}"
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.available:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+process_sampler = ProcessSampler(SAMPLER_INTERVAL, SAMPLER_TOP_K)
+
+@app.get("/system/processes/top")
+async def top_processes(metric: str = "cpu",
+                        k: int = Query(10, ge=1, le=SAMPLER_TOP_K),
+                        shaper: ResponseShaper = Depends(response_shaper)):
+    """Top-K processes by interval CPU%, RSS, RSS growth or I/O byte rates"""
+    if metric not in SAMPLER_METRICS:
+        raise HTTPException(status_code=400, detail=f"Invalid metric. Use: {list(SAMPLER_METRICS)}")
+    if process_sampler.sampled_at is None:
+        detail = "Process sampler not ready"
+        if process_sampler.last_error:
+            detail += f": {process_sampler.last_error}"
+        raise HTTPException(status_code=503, detail=detail)
+    return shaper.render({
+        "metric": metric,
+        "interval": process_sampler.interval,
+        "sampled_at": process_sampler.sampled_at,
+        "total_processes": process_sampler.process_count,
+        "last_error": process_sampler.last_error
+    }, "processes", process_sampler.top[metric][:k], key=None)
 
 # ========================= SYSTEM ADMINISTRATION ENDPOINTS =========================
 
+def collect_system_stats(timeout: Optional[float] = None) -> dict:
+    """Basic CPU, memory, disk and uptime figures from standard commands"""
+    # El timeout cubre los cuatro comandos en conjunto
+    end = time.monotonic() + timeout if timeout else None
+
+    def remaining():
+        return None if end is None else max(0.001, end - time.monotonic())
+
+    # CPU info
+    cpu_result = subprocess.run(['nproc'], capture_output=True, text=True, timeout=remaining())
+    cpu_cores = int(cpu_result.stdout.strip()) if cpu_result.stdout else 0
+    
+    # Memory info
+    mem_result = subprocess.run(['free', '-b'], capture_output=True, text=True, timeout=remaining())
+    mem_info = {}
+    if mem_result.stdout:
+        lines = mem_result.stdout.strip().split('\n')
+        if len(lines) > 1:
+            mem_parts = lines[1].split()
+            if len(mem_parts) >= 4:
+                mem_info = {
+                    "total": int(mem_parts[1]),
+                    "used": int(mem_parts[2]),
+                    "free": int(mem_parts[3]),
+                    "percent": round((int(mem_parts[2]) / int(mem_parts[1])) * 100, 2)
+                }
+    
+    # Disk info
+    disk_result = subprocess.run(['df', '-B1', '/'], capture_output=True, text=True,
+                                 timeout=remaining())
+    disk_info = {}
+    if disk_result.stdout:
+        lines = disk_result.stdout.strip().split('\n')
+        if len(lines) > 1:
+            disk_parts = lines[1].split()
+            if len(disk_parts) >= 4:
+                disk_info = {
+                    "total": int(disk_parts[1]),
+                    "used": int(disk_parts[2]),
+                    "free": int(disk_parts[3]),
+                    "percent": disk_parts[4]
+                }
+    
+    return {
+        "cpu": {"cores": cpu_cores},
+        "memory": mem_info,
+        "disk": disk_info,
+        "uptime": subprocess.run(['uptime'], capture_output=True, text=True,
+                                 timeout=remaining()).stdout.strip()
+    }
+
 @app.get("/system/stats")
-async def system_stats():
+async def system_stats(shaper: ResponseShaper = Depends(response_shaper)):
     """Basic system statistics using standard commands"""
     try:
-        # CPU info
-        cpu_result = subprocess.run(['nproc'], capture_output=True, text=True)
-        cpu_cores = int(cpu_result.stdout.strip()) if cpu_result.stdout else 0
-        
-        # Memory info
-        mem_result = subprocess.run(['free', '-b'], capture_output=True, text=True)
-        mem_info = {}
-        if mem_result.stdout:
-            lines = mem_result.stdout.strip().split('\n')
-            if len(lines) > 1:
-                mem_parts = lines[1].split()
-                if len(mem_parts) >= 4:
-                    mem_info = {
-                        "total": int(mem_parts[1]),
-                        "used": int(mem_parts[2]),
-                        "free": int(mem_parts[3]),
-                        "percent": round((int(mem_parts[2]) / int(mem_parts[1])) * 100, 2)
-                    }
-        
-        # Disk info
-        disk_result = subprocess.run(['df', '-B1', '/'], capture_output=True, text=True)
-        disk_info = {}
-        if disk_result.stdout:
-            lines = disk_result.stdout.strip().split('\n')
-            if len(lines) > 1:
-                disk_parts = lines[1].split()
-                if len(disk_parts) >= 4:
-                    disk_info = {
-                        "total": int(disk_parts[1]),
-                        "used": int(disk_parts[2]),
-                        "free": int(disk_parts[3]),
-                        "percent": disk_parts[4]
-                    }
-        
-        return {
-            "cpu": {"cores": cpu_cores},
-            "memory": mem_info,
-            "disk": disk_info,
-            "uptime": subprocess.run(['uptime'], capture_output=True, text=True).stdout.strip()
-        }
+        stats = collect_system_stats()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    return shaper.render(stats)
+
+def run_service_action(action: str, service_name: str, timeout: float = 30) -> dict:
+    """Run `systemctl <action> <service>` and describe the outcome"""
+    result = subprocess.run(['systemctl', action, service_name], 
+                          capture_output=True, text=True, timeout=timeout)
+    return {
+        "service": service_name,
+        "action": action,
+        "status": "success" if result.returncode == 0 else "failed",
+        "output": result.stdout.strip(),
+        "error": result.stderr.strip() if result.stderr else None,
+        "return_code": result.returncode
+    }
 
 @app.post("/system/service/{action}/{service_name}")
-async def manage_service(action: str, service_name: str):
+async def manage_service(action: str, service_name: str,
+                         shaper: ResponseShaper = Depends(response_shaper)):
     """Manage systemd services"""
     valid_actions = ['start', 'stop', 'restart', 'status', 'enable', 'disable']
     if action not in valid_actions:
         raise HTTPException(status_code=400, detail=f"Invalid action. Use: {valid_actions}")
     
     try:
-        result = subprocess.run(['systemctl', action, service_name], 
-                              capture_output=True, text=True, timeout=30)
-        return {
-            "service": service_name,
-            "action": action,
-            "status": "success" if result.returncode == 0 else "failed",
-            "output": result.stdout.strip()[:500],  # Limit output
-            "error": result.stderr.strip()[:500] if result.stderr else None,
-            "return_code": result.returncode
-        }
+        outcome = run_service_action(action, service_name)
     except subprocess.TimeoutExpired:
         raise HTTPException(status_code=408, detail="Service command timeout")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    return shaper.render(outcome)
 
 @app.post("/system/command/safe")
-async def execute_safe_command(command: dict):
+async def execute_safe_command(command: dict, shaper: ResponseShaper = Depends(response_shaper)):
     """Execute safe system commands with whitelist"""
     cmd = command.get('cmd')
     if not cmd:
@@ -421,45 +1158,335 @@ async def execute_safe_command(command: dict):
     try:
         result = subprocess.run(cmd, shell=True, capture_output=True, 
                               text=True, timeout=30)
-        return {
-            "command": cmd,
-            "status": "success" if result.returncode == 0 else "failed",
-            "return_code": result.returncode,
-            "stdout": result.stdout[:1000],  # Limit output
-            "stderr": result.stderr[:500] if result.stderr else None
-        }
     except subprocess.TimeoutExpired:
         raise HTTPException(status_code=408, detail="Command timeout")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    return shaper.render({
+        "command": cmd,
+        "status": "success" if result.returncode == 0 else "failed",
+        "return_code": result.returncode,
+        "stdout": result.stdout,
+        "stderr": result.stderr if result.stderr else None
+    })
+
+def collect_port_processes(port: int, timeout: Optional[float] = None) -> list:
+    """Processes holding sockets on a port, from `lsof -i :<port>`"""
+    result = subprocess.run(['lsof', '-i', f':{port}'], 
+                          capture_output=True, text=True, timeout=timeout)
+    
+    processes = []
+    for line in result.stdout.strip().split('\n')[1:]:
+        if line:
+            parts = line.split()
+            if len(parts) >= 9:
+                processes.append({
+                    "command": parts[0],
+                    "pid": int(parts[1]),
+                    "user": parts[2],
+                    "fd": parts[3],
+                    "type": parts[4],
+                    "name": parts[8]
+                })
+    return processes
+
+# Un mismo pid puede tener varias filas con igual nombre (IPv4/IPv6, fds duplicados)
+PORT_LISTING_KEY = ("pid", "type", "fd", "name")
 
 @app.get("/system/network/ports/{port}")
-async def check_port(port: int):
+async def check_port(port: int, shaper: ResponseShaper = Depends(response_shaper)):
     """Check what's running on specific port"""
     try:
-        result = subprocess.run(['lsof', '-i', f':{port}'], 
-                              capture_output=True, text=True)
-        
-        processes = []
-        for line in result.stdout.strip().split('\n')[1:]:
-            if line:
-                parts = line.split()
-                if len(parts) >= 9:
-                    processes.append({
-                        "command": parts[0],
-                        "pid": parts[1],
-                        "user": parts[2],
-                        "type": parts[4],
-                        "name": parts[8]
-                    })
-        
-        return {
-            "port": port,
-            "is_open": len(processes) > 0,
-            "processes": processes
-        }
+        processes = collect_port_processes(port)
     except Exception as e:
-        return {"port": port, "is_open": False, "error": str(e)}
+        return shaper.render({"port": port, "is_open": False, "error": str(e)},
+                             "processes", [], key=PORT_LISTING_KEY)
+    return shaper.render({"port": port, "is_open": len(processes) > 0},
+                         "processes", processes, key=PORT_LISTING_KEY)
+
+# ========================= SNAPSHOT AGGREGATOR =========================
+
+SNAPSHOT_DEADLINE = float(os.getenv("MCP_SNAPSHOT_DEADLINE", "2.0"))
+SNAPSHOT_MAX_SECTIONS = 32
+SNAPSHOT_WORKERS = int(os.getenv("MCP_SNAPSHOT_WORKERS", "8"))
+
+class SnapshotExecutor:
+    """Dedicated bounded thread pool so late sections never starve the default executor"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="snapshot")
+
+    def reserve(self, wanted: int) -> int:
+        """Claim up to `wanted` free workers; returns how many were granted"""
+        with self._lock:
+            granted = min(wanted, self.workers - self.in_flight)
+            self.in_flight += granted
+            return granted
+
+    def _release(self, _future):
+        with self._lock:
+            self.in_flight -= 1
+
+    def submit(self, fn, *args) -> asyncio.Future:
+        """Run fn on a worker already claimed with reserve()"""
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._release)
+        return asyncio.wrap_future(future)
+
+snapshot_executor = SnapshotExecutor(SNAPSHOT_WORKERS)
+
+def _port_section(arg: str, timeout: float) -> dict:
+    processes = collect_port_processes(int(arg), timeout)
+    return {"port": int(arg), "is_open": len(processes) > 0, "processes": processes}
+
+def _top_section(arg: str, timeout: float) -> dict:
+    metric = arg or "cpu"
+    if metric not in SAMPLER_METRICS:
+        raise ValueError(f"Invalid metric. Use: {list(SAMPLER_METRICS)}")
+    return {"metric": metric, "sampled_at": process_sampler.sampled_at,
+            "processes": process_sampler.top[metric]}
+
+# Secciones declarativas: "<tipo>" o "<tipo>:<argumento>"; reciben (argumento, timeout)
+SNAPSHOT_SECTIONS = {
+    "stats": lambda arg, timeout: collect_system_stats(timeout),
+    "processes": lambda arg, timeout: {"processes": collect_processes(timeout)},
+    "top": _top_section,
+    "port": _port_section,
+    "service": lambda arg, timeout: run_service_action("status", arg, timeout),
+}
+
+@app.get("/system/snapshot")
+async def system_snapshot(sections: str = "stats,processes",
+                          deadline: float = Query(SNAPSHOT_DEADLINE, gt=0, le=30),
+                          shaper: ResponseShaper = Depends(response_shaper)):
+    """Collect several /system/* views concurrently into one timestamped document"""
+    requested = [spec.strip() for spec in sections.split(",") if spec.strip()]
+    if not requested or len(requested) > SNAPSHOT_MAX_SECTIONS:
+        raise HTTPException(status_code=400,
+                            detail=f"Request between 1 and {SNAPSHOT_MAX_SECTIONS} sections")
+    for spec in requested:
+        kind = spec.partition(":")[0]
+        if kind not in SNAPSHOT_SECTIONS:
+            raise HTTPException(status_code=400,
+                                detail=f"Invalid section '{kind}'. Use: {list(SNAPSHOT_SECTIONS)}")
+
+    unique = list(dict.fromkeys(requested))
+    granted = snapshot_executor.reserve(len(unique))
+    if not granted:
+        raise HTTPException(status_code=503, detail="Snapshot workers saturated, retry later")
+
+    started = time.monotonic()
+    timestamp = datetime.now().isoformat()
+    tasks = {}
+    results = {}
+    for spec in unique[granted:]:
+        results[spec] = {"status": "skipped", "error": "Snapshot workers saturated"}
+    for spec in unique[:granted]:
+        kind, _, arg = spec.partition(":")
+        # Los subprocesos reciben el mismo deadline y terminan aunque la sección llegue tarde
+        tasks[spec] = snapshot_executor.submit(SNAPSHOT_SECTIONS[kind], arg, deadline)
+    if tasks:
+        await asyncio.wait(tasks.values(), timeout=deadline)
+
+    for spec, task in tasks.items():
+        if not task.done():
+            task.cancel()  # el hilo sigue hasta que su subproceso agote el timeout
+            results[spec] = {"status": "timeout"}
+        elif isinstance(task.exception(), subprocess.TimeoutExpired):
+            results[spec] = {"status": "timeout"}
+        elif task.exception() is not None:
+            results[spec] = {"status": "error", "error": str(task.exception())}
+        else:
+            results[spec] = {"status": "ok", "data": task.result()}
+    return shaper.render({
+        "timestamp": timestamp,
+        "elapsed": round(time.monotonic() - started, 4),
+        "deadline": deadline,
+        "complete": all(r["status"] == "ok" for r in results.values()),
+        "sections": {spec: results[spec] for spec in unique}
+    })
+
+# ========================= FLEET CONTROLLER =========================
+
+FLEET_CONCURRENCY = int(os.getenv("MCP_FLEET_CONCURRENCY", "16"))
+FLEET_TIMEOUT = float(os.getenv("MCP_FLEET_TIMEOUT", "10"))
+FLEET_METHODS = ("GET", "POST")
+
+def validate_node_url(url) -> str:
+    """Return a normalised http(s) base URL for a peer node or raise ValueError"""
+    if not isinstance(url, str):
+        raise ValueError("'url' must be a string")
+    url = url.strip().rstrip("/")
+    if any(c.isspace() for c in url):
+        raise ValueError(f"Invalid node url {url!r}")
+    try:
+        parsed = httpx.URL(url)
+        port = parsed.port
+    except Exception as e:
+        raise ValueError(f"Invalid node url {url!r}: {e}")
+    if parsed.scheme not in ("http", "https") or not parsed.host \
+            or parsed.query or parsed.fragment or (port is not None and not 0 < port < 65536):
+        raise ValueError(f"Invalid node url {url!r}: expected http(s)://host[:port]")
+    return url
+
+def parse_fleet_nodes(spec: str) -> dict:
+    """Parse 'name=url,name=url' (a bare url is named after its host:port)"""
+    nodes = {}
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, sep, url = entry.partition("=")
+        if not sep:
+            url = validate_node_url(entry)
+            name = httpx.URL(url).netloc.decode()
+        nodes[name.strip()] = validate_node_url(url)
+    return nodes
+
+def validate_fleet_path(path) -> str:
+    """Accept only literal /system/* paths; no dot segments or percent-encoding"""
+    if not isinstance(path, str):
+        raise HTTPException(status_code=400, detail="'path' must be a string")
+    route, _, query = path.partition("?")
+    # httpx normaliza los segmentos "..", así que se validan antes de construir la URL
+    if "%" in route or "\\" in route or "#" in path:
+        raise HTTPException(status_code=400, detail="'path' must not contain encoded characters")
+    segments = route.split("/")[1:]
+    if any(segment in (".", "..") for segment in segments) or "" in segments[:-1]:
+        raise HTTPException(status_code=400, detail="'path' must not contain dot or empty segments")
+    if not route.startswith("/system/") or httpx.URL(route).path != route:
+        raise HTTPException(status_code=400, detail="'path' must start with /system/")
+    return f"{route}?{query}" if query else route
+
+class FleetController:
+    """Registry of peer MCP nodes and concurrent fan-out over a pooled keep-alive client"""
+
+    def __init__(self, nodes: dict, concurrency: int, timeout: float, token: Optional[str] = None):
+        self.nodes = dict(nodes)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.token = token
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token else None
+        self.client = httpx.AsyncClient(
+            headers=headers,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.concurrency,
+                                max_keepalive_connections=self.concurrency)
+        )
+
+    async def stop(self):
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+
+    async def call(self, name: str, url: str, method: str, path: str, body: Optional[dict],
+                   timeout: float, semaphore: asyncio.Semaphore) -> dict:
+        async with semaphore:
+            start = time.monotonic()
+            result = {"node": name, "url": url}
+            try:
+                response = await self.client.request(method, url + path,
+                                                     json=body, timeout=timeout)
+                try:
+                    data = response.json()
+                except ValueError:
+                    data = response.text
+                result.update({"status_code": response.status_code, "result": data})
+            except Exception as e:
+                # Un nodo defectuoso nunca debe cortar el stream del resto
+                result["error"] = f"{type(e).__name__}: {e}"
+            result["elapsed"] = round(time.monotonic() - start, 4)
+            return result
+
+    async def fan_out(self, method: str, path: str, body: Optional[dict],
+                      targets: dict, timeout: float):
+        """Yield per-node results in completion order for a {name: url} snapshot"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = [asyncio.create_task(self.call(name, url, method, path, body, timeout, semaphore))
+                 for name, url in targets.items()]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+fleet = FleetController(parse_fleet_nodes(os.getenv("MCP_FLEET_NODES", "")),
+                        FLEET_CONCURRENCY, FLEET_TIMEOUT, os.getenv("MCP_FLEET_TOKEN"))
+
+@app.get("/fleet/nodes")
+async def list_fleet_nodes(token: str = Depends(verify_token)):
+    """List registered peer nodes"""
+    REQUEST_COUNT.labels(method="GET", endpoint="/fleet/nodes").inc()
+    return {"total_nodes": len(fleet.nodes), "nodes": fleet.nodes}
+
+@app.put("/fleet/nodes/{name}")
+async def register_fleet_node(name: str, node: dict, token: str = Depends(verify_token)):
+    """Register or update a peer node"""
+    REQUEST_COUNT.labels(method="PUT", endpoint="/fleet/nodes").inc()
+    try:
+        url = validate_node_url(node.get('url'))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    fleet.nodes[name] = url
+    return {"status": "registered", "node": name, "url": fleet.nodes[name]}
+
+@app.delete("/fleet/nodes/{name}")
+async def unregister_fleet_node(name: str, token: str = Depends(verify_token)):
+    """Remove a peer node from the registry"""
+    REQUEST_COUNT.labels(method="DELETE", endpoint="/fleet/nodes").inc()
+    if fleet.nodes.pop(name, None) is None:
+        raise HTTPException(status_code=404, detail=f"Node {name} not found")
+    return {"status": "unregistered", "node": name}
+
+@app.post("/fleet/fanout")
+async def fleet_fanout(request: dict, token: str = Depends(verify_token)):
+    """Run a /system/* operation on many nodes, streaming NDJSON results as they arrive"""
+    REQUEST_COUNT.labels(method="POST", endpoint="/fleet/fanout").inc()
+    method = str(request.get('method', 'GET')).upper()
+    if method not in FLEET_METHODS:
+        raise HTTPException(status_code=400, detail=f"Invalid method. Use: {list(FLEET_METHODS)}")
+    path = validate_fleet_path(request.get('path'))
+    names = request.get('nodes') or list(fleet.nodes)
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        raise HTTPException(status_code=400, detail="'nodes' must be a list of node names")
+    body = request.get('body')
+    if body is not None and not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="'body' must be a JSON object")
+    unknown = [name for name in names if name not in fleet.nodes]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Unknown nodes: {unknown}")
+    try:
+        timeout = float(request.get('timeout', fleet.timeout))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid 'timeout' parameter")
+    if not 0 < timeout <= 300:
+        raise HTTPException(status_code=400, detail="Invalid 'timeout' parameter")
+    # Copia del registro: un DELETE durante el fan-out no afecta a las llamadas pendientes
+    targets = {name: fleet.nodes[name] for name in dict.fromkeys(names)}
+
+    async def lines():
+        ok = failed = 0
+        async for result in fleet.fan_out(method, path, body, targets, timeout):
+            if "error" in result or result["status_code"] >= 400:
+                failed += 1
+            else:
+                ok += 1
+            yield json.dumps(result, separators=(",", ":")) + "\n"
+        summary = {"nodes": len(targets), "ok": ok, "failed": failed}
+        yield json.dumps({"summary": summary}, separators=(",", ":")) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    # permessage-deflate reserva contextos zlib por conexión; desactivado salvo que se pida
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("MCP_PORT", "8001")),
+                ws_per_message_deflate=os.getenv("MCP_WS_DEFLATE", "false").lower() == "true",
+                ws_ping_interval=WS_PROTOCOL_PING_INTERVAL,
+                ws_ping_timeout=WS_PROTOCOL_PING_TIMEOUT)
\ No newline at end of file
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""MCP Super Root Maestro - Prueba de carga de conexiones WebSocket inactivas
+
+Abre N clientes /ws que solo responden a los pings del servidor (de protocolo y,
+con --app-heartbeat, también los JSON), los mantiene
+abiertos y muestra /ws/stats (conexiones y memoria por conexión).
+
+    ulimit -n 200000
+    python ws-load-test.py --url ws://127.0.0.1:8001/ws --clients 50000 --hold 120
+
+Cada IP de origen tiene ~28k puertos efímeros, así que los clientes se reparten
+entre varias direcciones 127.0.0.x (--source-ips).
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+import websockets
+
+
+async def idle_client(url: str, source_ip: str, ready: asyncio.Event, stop: asyncio.Event,
+                      stats: dict, app_heartbeat: bool):
+    try:
+        async with websockets.connect(url, local_addr=(source_ip, 0), ping_interval=None,
+                                      open_timeout=30, max_queue=4) as ws:
+            stats["connected"] += 1
+            ready.set()
+            if app_heartbeat:
+                # Se adhiere al heartbeat JSON del servidor (pings y desconexión por inactividad)
+                await ws.send(json.dumps({"type": "pong"}))
+            while not stop.is_set():
+                message = await ws.recv()
+                if message.startswith("{") and json.loads(message).get("type") == "ping":
+                    await ws.send(json.dumps({"type": "pong"}))
+    except Exception:
+        stats["failed"] += 1
+        ready.set()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Idle WebSocket load test")
+    parser.add_argument("--url", default="ws://127.0.0.1:8001/ws")
+    parser.add_argument("--clients", type=int, default=50000)
+    parser.add_argument("--hold", type=float, default=60.0, help="seconds to keep clients open")
+    parser.add_argument("--source-ips", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--app-heartbeat", action="store_true",
+                        help="opt in to the JSON ping/pong heartbeat")
+    args = parser.parse_args()
+
+    stats_url = args.url.replace("ws://", "http://").replace("wss://", "https://").rsplit("/ws", 1)[0]
+    stats = {"connected": 0, "failed": 0}
+    stop = asyncio.Event()
+    tasks = []
+    start = time.monotonic()
+    for i in range(0, args.clients, args.batch):
+        events = []
+        for j in range(i, min(i + args.batch, args.clients)):
+            ready = asyncio.Event()
+            source_ip = f"127.0.0.{1 + j % args.source_ips}"
+            tasks.append(asyncio.create_task(idle_client(args.url, source_ip, ready, stop, stats,
+                                                         args.app_heartbeat)))
+            events.append(ready.wait())
+        await asyncio.gather(*events)
+        print(f"\r{stats['connected']} connected, {stats['failed']} failed", end="", flush=True)
+    print(f"\nRamp-up: {time.monotonic() - start:.1f}s")
+
+    async with httpx.AsyncClient() as client:
+        deadline = time.monotonic() + args.hold
+        while time.monotonic() < deadline:
+            response = await client.get(f"{stats_url}/ws/stats")
+            print(response.json())
+            await asyncio.sleep(min(10.0, max(0.0, deadline - time.monotonic())))
+
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())